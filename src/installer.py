@@ -1,9 +1,28 @@
 #!/usr/bin/python
+import asyncio
+import concurrent.futures
+import contextlib
+import copy
 import json
+import mmap
+import os
+import re
 import sys
 import getopt
+import glob
+import gzip
+import hashlib
+import http.server
+import shlex
+import signal
+import shutil
+import stat
+import struct
 import subprocess
+import tempfile
+import threading
 import time
+import urllib.request
 
 # What to do to setup some bootloaders correctly
 _known_bootloaders = {
@@ -43,8 +62,11 @@ _process = {
     'first_setup': 'configure_filesystems',  # chain starts from this step (can be modified by exec cmdline)
     'pacman_refreshed': False,
     'pkgbuild_ready': False,
+    'bench_spawn': 0,  # if set, only spawn benchmark with this processes count is run (--bench-spawn=N)
+    'check_mirrors': False,  # if set, only mirror ranking self-check is run (--check-mirrors)
     'setup_chain': [  # setup steps chain
         'configure_filesystems',
+        'configure_mirrors',
         'install_world',
         'install_kernel',
         'install_aur',
@@ -54,9 +76,28 @@ _process = {
         'save_configuration',
         'scripts',
         'script_packages',
+        'verify_installation',
     ],
     'needed_system_scripts': [],  # scripts that setup steps asked to install
     'needed_script_packages': [],  # packages needed for scripts ^
+    'snapshots': [],  # [{'step': name, 'path': snapshot path, 'state': saved lists}, ...] after successful steps
+    'snapshot_trash': [],  # broken roots replaced by snapshots, deleted with snapshots
+    'watchdog': {  # command timeouts and stall detection
+        'interval': 5,  # seconds between process progress checks
+        'stall_timeout': 180,  # seconds without output, I/O or CPU progress before kill
+        'default_timeout': 3600,  # timeout for commands without run history
+        'min_timeout': 300,  # adaptive timeout is never lower
+        'timeout_factor': 4,  # adaptive timeout is factor * slowest successful run
+        'history': 20,  # durations kept per command class
+        'kill_grace': 10,  # seconds killed command gets to exit by itself, then for SIGTERM
+    },
+    'command_stats': None,  # {command class: [durations]}, loaded from _options['command_stats']
+    'resource_limits': {  # how many parallel (async) commands can use resource class at once
+        'network': 4,
+        'disk': 2,
+        'cpu': os.cpu_count() or 1,
+        'pacman': 1,  # pacman database is locked by every pacman/pacstrap run
+    },
 }
 
 # Static installation/configuration data
@@ -69,6 +110,13 @@ _options = {
     'params': [],  # cmdline params
     'arguments': [],  # params ^ values
     'configFile': "worldconfig.json", # path to install config
+    'mirrorlist': "/etc/pacman.d/mirrorlist",  # live system mirrorlist. pacstrap copies it to installation
+    'pacman_conf': "/etc/pacman.conf",  # live system pacman config
+    'mirror_cache': "mirrors_cache.json",  # mirror probe results from previous runs
+    'command_stats': "command_stats.json",  # successful command durations from previous runs
+    'snapshot_pool': "/run/adi-pool",  # where btrfs top-level volume of root partition is mounted
+    'root_subvolume': "@",  # btrfs subvolume installation root lives in (if snapshots are used)
+    'verify_report': "/usr/local/share/adi/verify_report.json",  # saved locally and to installation
     'configData': {} # deserialized content of install config
 }
 
@@ -76,6 +124,12 @@ _options = {
 _system = None
 _bootloader = None
 
+# Semaphores for _process['resource_limits'], created for every run_parallel() event loop
+_resources = {}
+
+# Running pacman database sync task, shared by all parallel installs of run_parallel() event loop
+_pacman_sync = None
+
 
 # Write log to file
 def log(line) -> None:
@@ -96,40 +150,429 @@ def read(prompt: str) -> str:
     return answer
 
 
-def run_command(cmd: str, args: list, user=None, nofail=False, direct=False, stdin: str = None, timeout=600,
-                attempts=1, env=None) -> int:
+def parse_env(env: str) -> dict:
+    """
+    Parse environment string to dict.
+
+    :param env: special enviromnent variables, format "GOCACHE=off XWAYLAND=false" etc
+    :return: {name: value} dict. Empty if env is empty or None
+    """
+    if not env:
+        return {}
+    return dict(var.split('=', 1) for var in shlex.split(env))
+
+
+def build_command(cmd: str, args: list, user=None, env=None) -> (list, dict):
+    """
+    Build argv list and process environment for command. No shell is involved.
+
+    :param cmd: command execution name
+    :param args: arguments of command. Every list entry is exactly one argv entry
+    :param user: run command by specified users name
+    :param env: special enviromnent variables, format "GOCACHE=off XWAYLAND=false" etc
+    :return: (argv, environment) pair. environment is None if nothing to change
+    """
+    args = list(filter(lambda x: x != "", args))
+    env = parse_env(env)
+    argv = [cmd] + args
+
+    # Use sudo to run from other user
+    # sudo resets environment, so we have to ask it to keep our variables
+    if user:
+        preserve = ['--preserve-env=' + ','.join(env.keys())] if env else []
+        argv = ['sudo', '--user=' + user] + preserve + argv
+
+    return argv, {**os.environ, **env} if env else None
+
+
+def resolve_executable(cmd: str, env=None) -> str:
+    """
+    Find absolute path of command the same way shell does.
+
+    :param cmd: command execution name
+    :param env: full process environment. None for current one
+    :return: absolute executable path
+    """
+    path = (env or os.environ).get('PATH', os.defpath)
+    executable = shutil.which(cmd, path=path)
+    if not executable:
+        raise FileNotFoundError("No such command: " + cmd)
+    return executable
+
+
+def echo_exec(argv: list, env=None, cwd=None, output=None, append=False) -> None:
+    """
+    Echo command that is going to be executed in shell-like look.
+
+    :param argv: full argv list
+    :param env: special enviromnent variables string
+    :param cwd: directory command runs in
+    :param output: file stdout is redirected to
+    :param append: is stdout appended to output file
+    """
+    echo('EXEC: ', ' '.join(filter(None, [
+        env,
+        shlex.join(argv),
+        ('>> ' if append else '> ') + output if output else '',
+        '(in ' + cwd + ')' if cwd else ''
+    ])))
+
+
+def log_output(out: str, err: str) -> None:
+    """
+    Write captured process output to log.
+
+    :param out: process stdout
+    :param err: process stderr. Also printed to terminal
+    """
+    with open(_process['logfile'], 'a') as log:
+        if out:
+            log.write("<CommandOutput>\n")
+            log.write(out)
+            log.write("\n</CommandOutput>\n")
+        if err:
+            log.write("\n<Error>\n" + err + "</Error>\n")
+            print(err)
+
+
+def retry_needed(result: int, attempts: int, total_attempts: int, nofail: bool) -> bool:
+    """
+    Decide what to do after command attempt finished.
+
+    Shared by run_command() and run_command_async() so retries work the same way.
+
+    :param result: returncode of attempt
+    :param attempts: attempts left, including finished one
+    :param total_attempts: attempts command was started with
+    :param nofail: do not raise error on command execution fail
+    :return: True if command has to be restarted
+    """
+    echo("  RET: {}".format(result))
+
+    if result == 0:
+        return False
+    elif attempts > 1:
+        echo("Failed {}/{} attempts. Retrying...".format(attempts, total_attempts))
+        return True
+    # This check must be done after attempts > 1
+    # Because even with nofail=True if execution fails, we will retry it
+    elif nofail:
+        return False
+    raise Exception('  ' * _process['log_depth'] + "Command Error!")
+
+
+def command_class(argv: list) -> str:
+    """
+    Name command for run statistics, ex. "pacstrap", "git clone", "chroot makepkg -d".
+
+    sudo, env and arch-chroot wrappers are skipped. First argument is a part of the name
+    if it looks like option or subcommand, not like path or text.
+
+    :param argv: full argv list
+    :return: command class name
+    """
+    words = list(argv)
+    prefix = ''
+    while words:
+        name = os.path.basename(words[0])
+        if name == 'sudo':
+            words = words[1:]
+            while words and words[0].startswith('-'):
+                words = words[1:]
+        elif name == 'env':
+            words = words[1:]
+            while words and (words[0].startswith('-') or '=' in words[0]):
+                words = words[2:] if words[0] == '-C' else words[1:]
+        elif name == 'arch-chroot':
+            prefix = 'chroot '
+            words = words[2:]
+        else:
+            break
+
+    if not words:
+        return prefix.strip()
+    name = os.path.basename(words[0])
+    if len(words) > 1 and re.fullmatch(r'-{0,2}[A-Za-z][\w-]*', words[1]):
+        name += ' ' + words[1]
+    return prefix + name
+
+
+def command_stats() -> dict:
+    """
+    Get command run statistics, loading them from _options['command_stats'] on first use.
+
+    :return: {command class: [durations of successful runs]}
+    """
+    if _process['command_stats'] is None:
+        try:
+            with open(_options['command_stats'], 'r') as file:
+                _process['command_stats'] = json.load(file)
+        except (OSError, ValueError):
+            _process['command_stats'] = {}
+    return _process['command_stats']
+
+
+def record_duration(name: str, seconds: float) -> None:
+    """
+    Remember duration of successful command run for future timeouts.
+
+    :param name: command class, see command_class()
+    :param seconds: run duration
+    """
+    history = command_stats().setdefault(name, [])
+    history.append(round(seconds, 3))
+    del history[:-_process['watchdog']['history']]
+    try:
+        with open(_options['command_stats'], 'w') as file:
+            json.dump(command_stats(), file)
+    except OSError as err:
+        log("Command stats are not saved: " + str(err))
+
+
+def command_timeout(name: str, timeout=None) -> float:
+    """
+    Choose command timeout.
+
+    Explicit timeout is used as is. Otherwise it adapts to previous successful runs of command class.
+
+    :param name: command class, see command_class()
+    :param timeout: explicit timeout or None
+    :return: seconds before kill
+    """
+    if timeout is not None:
+        return timeout
+
+    watchdog = _process['watchdog']
+    history = command_stats().get(name, [])
+    # Too few runs to trust them
+    if len(history) < 3:
+        return watchdog['default_timeout']
+    return max(watchdog['min_timeout'], watchdog['timeout_factor'] * max(history))
+
+
+def process_tree(pid: int) -> dict:
+    """
+    Find process and all its descendants.
+
+    :param pid: root process id
+    :return: {pid: cpu ticks (own and of reaped children)}
+    """
+    children = {}
+    ticks = {}
+    for path in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(path, 'r') as file:
+                # Process name can contain spaces and brackets, so fields are counted from the last ')'
+                fields = file.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # Zombie has already exited, it is only waiting to be reaped
+        if fields[0] == 'Z':
+            continue
+        child = int(path.split('/')[2])
+        children.setdefault(int(fields[1]), []).append(child)
+        ticks[child] = sum(int(tick) for tick in fields[11:15])  # utime stime cutime cstime
+
+    tree = {}
+    queue = [pid]
+    while queue:
+        current = queue.pop()
+        if current in ticks and current not in tree:
+            tree[current] = ticks[current]
+            queue += children.get(current, [])
+    return tree
+
+
+def process_progress(pid: int) -> tuple:
+    """
+    Sample progress of process tree. Any change between samples means process is alive.
+
+    Output to pipes and files counts as I/O too.
+
+    :param pid: root process id
+    :return: (cpu ticks, bytes read and written, processes count)
+    """
+    tree = process_tree(pid)
+    io = 0
+    for child in tree:
+        try:
+            with open('/proc/{}/io'.format(child), 'r') as file:
+                io += sum(int(line.split()[1]) for line in file if line.startswith(('rchar', 'wchar')))
+        except (OSError, ValueError):
+            continue
+    return sum(tree.values()), io, len(tree)
+
+
+def process_exited(pid: int) -> bool:
+    """
+    Check if process has exited (is a zombie or gone).
+
+    :param pid: process id
+    :return: True if exited
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'r') as file:
+            return file.read().rsplit(')', 1)[1].split()[0] == 'Z'
+    except (OSError, IndexError):
+        return True
+
+
+def kill_tree(pid: int) -> None:
+    """
+    Kill all descendants of process, then let process itself exit.
+
+    Process itself is not SIGKILLed at once: ex. arch-chroot has to unmount its bind mounts on exit.
+    It usually exits as soon as its command is killed. If not, it gets SIGTERM and then SIGKILL,
+    each after _process['watchdog']['kill_grace'] seconds. Process without descendants is a leaf
+    command, not a wrapper waiting for them: it gets SIGTERM at once.
+
+    :param pid: root process id
+    """
+    # Processes may fork while we kill them
+    wrapper = False
+    for _ in range(3):
+        children = [child for child in process_tree(pid) if child != pid]
+        if not children:
+            break
+        wrapper = True
+        for child in children:
+            try:
+                os.kill(child, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                continue
+
+    for sig in ((None,) if wrapper else ()) + (signal.SIGTERM, signal.SIGKILL):
+        if sig:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                return
+        deadline = time.monotonic() + _process['watchdog']['kill_grace']
+        while time.monotonic() < deadline:
+            if process_exited(pid):
+                return
+            time.sleep(0.1)
+
+
+def watchdog_start(timeout: float, stall: float, adaptive=False) -> dict:
+    """
+    Start watching command run.
+
+    :param timeout: seconds before kill
+    :param stall: seconds without progress before kill. 0 to not check progress
+    :param adaptive: timeout is only a guess from history (see command_timeout()). After it passes,
+                     process is killed only when it stops making progress
+    :return: watchdog state for watchdog_check()
+    """
+    now = time.monotonic()
+    return {'begin': now, 'timeout': timeout, 'stall': stall, 'adaptive': adaptive,
+            'progress': None, 'progress_time': now}
+
+
+def watchdog_check(guard: dict, pid: int) -> str:
+    """
+    Check if watched process has to be killed.
+
+    Shared by run_command() and run_command_async().
+
+    :param guard: watchdog state from watchdog_start()
+    :param pid: process id
+    :return: kill reason or None
+    """
+    now = time.monotonic()
+    overdue = now - guard['begin'] >= guard['timeout']
+    if overdue and not guard['adaptive']:
+        return "timeout {:.0f}s exceeded".format(guard['timeout'])
+
+    # Overdue command is sampled even without stall check, it must show progress to live
+    if guard['stall'] or overdue:
+        progress = process_progress(pid)
+        if progress != guard['progress']:
+            guard['progress'] = progress
+            guard['progress_time'] = now
+        elif overdue:
+            return "timeout {:.0f}s exceeded and no progress since last check".format(guard['timeout'])
+        elif now - guard['progress_time'] >= guard['stall']:
+            return "no output, I/O or CPU progress for {:.0f}s".format(now - guard['progress_time'])
+    return None
+
+
+def watch_command(name: str, timeout, stall: float, direct: bool) -> dict:
+    """
+    Start watchdog for command run with run_command() rules.
+
+    Interactive (direct) command waits for user, who may think for long. It has no stall check,
+    and no timeout unless caller gives one explicitly.
+
+    :param name: command class, see command_class()
+    :param timeout: explicit timeout or None to adapt it to previous runs
+    :param stall: seconds without progress before kill
+    :param direct: command is interactive
+    :return: watchdog state for watchdog_check()
+    """
+    if direct:
+        return watchdog_start(timeout if timeout is not None else float('inf'), 0)
+    return watchdog_start(command_timeout(name, timeout), stall, adaptive=timeout is None)
+
+
+def spawn(argv: list, cwd=None, env=None, stdin=None, stdout=None, stderr=None) -> subprocess.Popen:
+    """
+    Start process from argv list without a shell.
+
+    Executable is resolved to absolute path and fds are not closed, so CPython can use posix_spawn(3)
+    where available. If cwd is set it falls back to vfork/fork+exec, still without /bin/sh.
+
+    :param argv: full argv list. argv[0] is command execution name
+    :param cwd: process working directory
+    :param env: full process environment. None to inherit current one
+    :param stdin: subprocess.PIPE or None
+    :param stdout: subprocess.PIPE, opened file or None
+    :param stderr: subprocess.PIPE, opened file or None
+    :return: started process
+    """
+    return subprocess.Popen(argv, executable=resolve_executable(argv[0], env), close_fds=False, cwd=cwd, env=env,
+                            stdin=stdin, stdout=stdout, stderr=stderr, encoding='utf-8')
+
+
+def run_command(cmd: str, args: list, user=None, nofail=False, direct=False, stdin: str = None, timeout=None,
+                attempts=1, env=None, cwd=None, output=None, append=False, stall=None) -> int:
     """
     Every command running in OS must be runned through this function.
 
     But if you want to chroot or change execution dir, dont use this function. See run_chroot() and run_chdir().
+    Command is spawned directly from argv, there is no shell. So no '>', '&&', globs or quotes in args.
+
+    Command is watched: it is killed if it makes no progress (output, I/O, CPU) for stall seconds
+    or runs longer than timeout. Kill is a fail, just like returncode != 0.
 
     :param cmd: command execution name
-    :param args: arguments and further commands with their arguments
+    :param args: arguments of command. Every list entry is exactly one argument
     :param user: run command by specified users name
     :param nofail: do not raise error on command execution fail (returncode != 0 ot timeout)
     :param direct: input/output will be transparent provided to current terminal
     :param stdin: sting that will be putted to process stdin (ignored if direct=True)
-    :param timeout: process timeout before force kill
+    :param timeout: process timeout before force kill. If None, adapted to previous runs (see command_timeout())
+                    and command is killed after it only if it makes no progress. If None and direct=True - no timeout
     :param attempts: if process fails (returncode != 0 or timeout) it can be restarted N-1 times
     :param env: special enviromnent variables, format "GOCACHE=off XWAYLAND=false" etc
-    :return: returncode of process. If, for some reason, process gives no returncode, will return 0
+    :param cwd: local directory to run command in
+    :param output: file path to write process stdout to instead of log (like '>')
+    :param append: append stdout to output file instead of overwriting (like '>>')
+    :param stall: seconds without progress before kill. If None, _process['watchdog']['stall_timeout'].
+                  0 - no stall check. Never checked if direct=True, because user may think for long
+    :return: returncode of process. Negative signal number if process was killed
     """
     # For pretty log, echo, read look
     _process['log_depth'] += 1
-    args = list(filter(lambda x: x != "", args))
     total_attempts = attempts
 
-    # Use sudo to run from other user
-    if user:
-        command = "sudo --user=" + user + " " + ' '.join([cmd] + args)
-    else:
-        command = ' '.join([cmd] + args)
-
-    # if env string set
-    if env:
-        command = "env " + env + " " + command
+    argv, environment = build_command(cmd, args, user=user, env=env)
+    name = command_class(argv)
+    interval = _process['watchdog']['interval']
+    if stall is None:
+        stall = _process['watchdog']['stall_timeout']
 
-    echo('EXEC: ', command)
+    echo_exec(argv, env=env, cwd=cwd, output=output, append=append)
 
     # If there is stdin string, will create PIPE
     stdin_pipe = None
@@ -145,46 +588,87 @@ def run_command(cmd: str, args: list, user=None, nofail=False, direct=False, std
 
     # Because attempts. Guaranteed that will not be infinity by 'if' statements
     while True:
-        p = subprocess.Popen(command, shell=True, stdin=stdin_pipe, stdout=stdout_pipe, stderr=stderr_pipe, encoding='utf-8')
-        # for process Timeout exception handling
+        # Redirection is done by us, not by shell. File is reopened for every attempt
+        outfile = open(output, 'a' if append else 'w') if output else None
         try:
-            output, err = p.communicate(input=stdin, timeout=timeout)
+            p = spawn(argv, cwd=cwd, env=environment, stdin=stdin_pipe,
+                      stdout=outfile or stdout_pipe, stderr=stderr_pipe)
+        except (FileNotFoundError, NotADirectoryError, PermissionError) as err:
+            # Same code shell gives for unknown command
+            echo(str(err))
+            p = None
+        if p:
+            guard = watch_command(name, timeout, stall, direct)
+            killed = None
+            pending_input = stdin
+            # Wake up every interval to look after process, output is collected meanwhile
+            while True:
+                try:
+                    out, err = p.communicate(input=pending_input, timeout=interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    # Input is sent once, the rest of communication continues without it
+                    pending_input = None
+                    if killed := watchdog_check(guard, p.pid):
+                        kill_tree(p.pid)
+                        try:
+                            out, err = p.communicate(timeout=interval)
+                        except subprocess.TimeoutExpired:
+                            # Someone outside of tree still holds pipes. Do not wait for them
+                            p.wait()
+                            out, err = None, None
+                        break
+            if outfile:
+                outfile.close()
             # Because for direct=True we do not write a log
             if not direct:
-                with open(_process['logfile'], 'a') as log:
-                    if output:
-                        log.write("<CommandOutput>\n")
-                        log.write(output)
-                        log.write("\n</CommandOutput>\n")
-                    if err:
-                        log.write("\n<Error>\n" + err + "</Error>\n")
-                        print(err)
-        except subprocess.TimeoutExpired:
-            p.kill()
-
-        # If no returncode, set it as 0
-        # We do it because we can
-        # fixme
-        result = p.returncode if p.returncode else 0
-        echo("  RET: {}".format(result))
+                log_output(out, err)
+
+            # Process itself may exit normally after its descendants are killed. It is still a fail
+            result = p.returncode if p.returncode or not killed else -signal.SIGKILL
+            if killed:
+                echo("  KILLED: " + killed)
+            # Interactive run time is user's time, not command's
+            elif result == 0 and not direct:
+                record_duration(name, time.monotonic() - guard['begin'])
+        else:
+            if outfile:
+                outfile.close()
+            result = 127
 
         # Cycle end its end guarantee
-        if result == 0:
+        if not retry_needed(result, attempts, total_attempts, nofail):
             break
-        elif attempts > 1:
-            echo("Failed {}/{} attempts. Retrying...".format(attempts, total_attempts))
-            attempts -= 1
-        # This check must be done after attempts > 1
-        # Because even with nofail=True if execution fails, we will retry it
-        elif nofail:
-            break
-        else:
-            raise Exception('  ' * _process['log_depth'] + "Command Error!")
+        attempts -= 1
     _process['log_depth'] -= 1
     return result
 
 
-def run_chroot(cmd: str, args: list, user=None, **kwargs) -> int:
+def chroot_command(cmd: str, args: list, user=None, cwd=None, env=None) -> list:
+    """
+    Build argv to run command in installation chroot.
+
+    :param cmd: command execution name
+    :param args: arguments of command
+    :param user: run command by specified users name
+    :param cwd: directory inside installation to run command in
+    :param env: special enviromnent variables, format "GOCACHE=off XWAYLAND=false" etc
+    :return: arguments for arch-chroot
+    """
+    argv = [cmd] + args
+    # chroot itself can not change directory, env -C can. Variables are put there too,
+    # because sudo inside chroot will reset them
+    if cwd or env:
+        argv = ['env'] + (['-C', cwd] if cwd else []) + shlex.split(env or '') + argv
+    # We have to deal with user there, not in run_command
+    # Because if we use run_command, cmd looks like 'sudo arch-chroot'.
+    # Not a thing we want. We need arch-chroot /mnt sudo:
+    if user:
+        argv = ['sudo', '--user=' + user] + argv
+    return [_options['install']] + argv
+
+
+def run_chroot(cmd: str, args: list, user=None, cwd=None, env=None, **kwargs) -> int:
     """
     Run command in installation chroot.
 
@@ -192,17 +676,14 @@ def run_chroot(cmd: str, args: list, user=None, **kwargs) -> int:
     But if you need to execute in some directory, dont use run_chroot. Look for run_chdir(chroot=True).
 
     :param cmd: command execution name
-    :param args: arguments and further commands with their arguments
+    :param args: arguments of command
     :param user: run command by specified users name
+    :param cwd: directory inside installation to run command in
+    :param env: special enviromnent variables, format "GOCACHE=off XWAYLAND=false" etc
     :param kwargs: other keywork arguments for run_command
     :return: full execution returncode
     """
-    # We have to deal with user there, not in run_command
-    # Because if we use run_command, cmd looks like 'sudo arch-chroot'.
-    # Not a thing we want. We need arch-chroot /mnt sudo:
-    if user:
-        return run_command("arch-chroot", [_options['install'], 'sudo', '--user=' + user, cmd] + args, **kwargs)
-    return run_command("arch-chroot", [_options['install'], cmd] + args, **kwargs)
+    return run_command("arch-chroot", chroot_command(cmd, args, user=user, cwd=cwd, env=env), **kwargs)
 
 
 def run_chdir(path: str, cmd: str, args: list, chroot=False, user=None, **kwargs) -> int:
@@ -214,21 +695,208 @@ def run_chdir(path: str, cmd: str, args: list, chroot=False, user=None, **kwargs
 
     :param path: local directory path
     :param cmd: command execution name
-    :param args: arguments and further commands with their arguments
+    :param args: arguments of command
     :param chroot: do a chroot to installation, then cd, then cmd
     :param user: run command by specified users name
     :param kwargs: arguments for run_command and run_chroot (if chroot=True)
     :return: full execution returncode
     """
-    # We have to deal with chroot here, not in run_chroot
-    # Because if we use run_chroot directly, command will be arch-chroot /mnt cd ...
-    # We need arch-chroot /mnt sh -c "cd... because only this will work
     if chroot:
-        return run_chroot("sh", ['-c', '"', 'cd', path, '&&', cmd] + args + ['"'], user=user, **kwargs)
-    # For the same ^ reasons we dealing with user here
-    if user:
-        return run_command("sudo", ['--user=' + user, 'sh', '-c', '"', 'cd', path, '&&', cmd, *args, '"'], **kwargs)
-    return run_command("cd", [path, '&&', cmd] + args, user=user, **kwargs)
+        return run_chroot(cmd, args, user=user, cwd=path, **kwargs)
+    return run_command(cmd, args, user=user, cwd=path, **kwargs)
+
+
+async def run_command_async(cmd: str, args: list, user=None, nofail=False, direct=False, stdin: str = None,
+                            timeout=None, attempts=1, env=None, cwd=None, output=None, append=False, stall=None,
+                            resources=()) -> int:
+    """
+    Awaitable version of run_command(). Can be used only in coroutines started by run_parallel().
+
+    Timeout, stall watchdog, retries and nofail work exactly as in run_command().
+    Command waits until every resource class it uses has a free slot. If coroutine is cancelled,
+    process is killed.
+
+    :param cmd: command execution name
+    :param args: arguments of command. Every list entry is exactly one argument
+    :param user: run command by specified users name
+    :param nofail: do not raise error on command execution fail (returncode != 0 ot timeout)
+    :param direct: input/output will be transparent provided to current terminal
+    :param stdin: sting that will be putted to process stdin (ignored if direct=True)
+    :param timeout: process timeout before force kill. If None, adapted to previous runs (see command_timeout())
+                    and command is killed after it only if it makes no progress. If None and direct=True - no timeout
+    :param attempts: if process fails (returncode != 0 or timeout) it can be restarted N-1 times
+    :param env: special enviromnent variables, format "GOCACHE=off XWAYLAND=false" etc
+    :param cwd: local directory to run command in
+    :param output: file path to write process stdout to instead of log (like '>')
+    :param append: append stdout to output file instead of overwriting (like '>>')
+    :param stall: seconds without progress before kill, see run_command()
+    :param resources: resource classes command uses, keys of _process['resource_limits']
+    :return: returncode of process. Negative signal number if process was killed
+    """
+    _process['log_depth'] += 1
+    total_attempts = attempts
+
+    argv, environment = build_command(cmd, args, user=user, env=env)
+    name = command_class(argv)
+    interval = _process['watchdog']['interval']
+    if stall is None:
+        stall = _process['watchdog']['stall_timeout']
+
+    stdin_pipe = subprocess.PIPE if stdin else None
+    stdout_pipe = None if direct else subprocess.PIPE
+    stderr_pipe = None if direct else subprocess.PIPE
+
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            # Always the same order, so two commands never wait for each other's resources
+            for resource in sorted(set(resources)):
+                await stack.enter_async_context(_resources[resource])
+
+            echo_exec(argv, env=env, cwd=cwd, output=output, append=append)
+
+            while True:
+                outfile = open(output, 'a' if append else 'w') if output else None
+                try:
+                    p = await asyncio.create_subprocess_exec(
+                        *argv, executable=resolve_executable(argv[0], environment), close_fds=False, cwd=cwd,
+                        env=environment, stdin=stdin_pipe, stdout=outfile or stdout_pipe, stderr=stderr_pipe)
+                except (FileNotFoundError, NotADirectoryError, PermissionError) as err:
+                    echo(str(err))
+                    p = None
+
+                killed = None
+                try:
+                    if p:
+                        guard = watch_command(name, timeout, stall, direct)
+                        talk = asyncio.ensure_future(p.communicate(input=stdin.encode() if stdin else None))
+                        while not (await asyncio.wait({talk}, timeout=interval))[0]:
+                            if killed := watchdog_check(guard, p.pid):
+                                await asyncio.to_thread(kill_tree, p.pid)
+                                # Someone outside of tree may still hold pipes. Do not wait for them
+                                if not (await asyncio.wait({talk}, timeout=interval))[0]:
+                                    talk.cancel()
+                                    await p.wait()
+                                break
+
+                        out, err = talk.result() if not talk.cancelled() else (None, None)
+                        if not direct:
+                            log_output(out.decode() if out else '', err.decode() if err else '')
+                except asyncio.CancelledError:
+                    # Something else in chain failed, do not leave process behind
+                    await asyncio.to_thread(kill_tree, p.pid)
+                    await p.wait()
+                    raise
+                finally:
+                    if outfile:
+                        outfile.close()
+
+                if not p:
+                    result = 127
+                else:
+                    result = p.returncode if p.returncode or not killed else -signal.SIGKILL
+                    if killed:
+                        echo("  KILLED: " + killed)
+                    elif result == 0 and not direct:
+                        record_duration(name, time.monotonic() - guard['begin'])
+
+                if not retry_needed(result, attempts, total_attempts, nofail):
+                    break
+                attempts -= 1
+    finally:
+        _process['log_depth'] -= 1
+    return result
+
+
+async def run_chroot_async(cmd: str, args: list, user=None, cwd=None, env=None, **kwargs) -> int:
+    """
+    Awaitable version of run_chroot().
+
+    :param cmd: command execution name
+    :param args: arguments of command
+    :param user: run command by specified users name
+    :param cwd: directory inside installation to run command in
+    :param env: special enviromnent variables, format "GOCACHE=off XWAYLAND=false" etc
+    :param kwargs: other keywork arguments for run_command_async
+    :return: full execution returncode
+    """
+    return await run_command_async("arch-chroot", chroot_command(cmd, args, user=user, cwd=cwd, env=env), **kwargs)
+
+
+async def run_chdir_async(path: str, cmd: str, args: list, chroot=False, user=None, **kwargs) -> int:
+    """
+    Awaitable version of run_chdir().
+
+    :param path: local directory path
+    :param cmd: command execution name
+    :param args: arguments of command
+    :param chroot: do a chroot to installation, then cd, then cmd
+    :param user: run command by specified users name
+    :param kwargs: arguments for run_command_async and run_chroot_async (if chroot=True)
+    :return: full execution returncode
+    """
+    if chroot:
+        return await run_chroot_async(cmd, args, user=user, cwd=path, **kwargs)
+    return await run_command_async(cmd, args, user=user, cwd=path, **kwargs)
+
+
+def run_parallel(*coroutines) -> list:
+    """
+    Run awaitables concurrently from synchronous code, e.g. from chain setup step.
+
+    If any of them fails, the rest are cancelled (their processes killed) and error is raised further,
+    so run_setup() treats the step as failed.
+
+    :param coroutines: awaitables, usually *_async() calls
+    :return: their results in the same order
+    """
+    return asyncio.run(gather_chain(*coroutines))
+
+
+async def gather_chain(*coroutines) -> list:
+    """
+    Await all coroutines, cancel all of them on first failure.
+
+    :param coroutines: awaitables
+    :return: their results in the same order
+    """
+    global _pacman_sync
+    # Semaphores and tasks belong to event loop, so every run gets its own
+    for name, limit in _process['resource_limits'].items():
+        _resources[name] = asyncio.Semaphore(limit)
+    _pacman_sync = None
+
+    tasks = [asyncio.ensure_future(coro) for coro in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def bench_spawn(count: int) -> bool:
+    """
+    Micro-benchmark of process spawn overhead.
+
+    Full installation runs hundreds of commands. Compare old shell=True way with argv spawn().
+
+    :param count: how many processes to spawn for every way
+    :return: True if all fine
+    """
+    # Not a shell builtin, so shell has to exec it as every real command
+    argv = ['uname', '-a']
+    ways = {
+        'shell': lambda: subprocess.Popen(' '.join(argv), shell=True, stdout=subprocess.DEVNULL),
+        'spawn': lambda: spawn(argv, stdout=subprocess.DEVNULL),
+    }
+    for name, start in ways.items():
+        begin = time.perf_counter()
+        for _ in range(count):
+            start().wait()
+        spent = time.perf_counter() - begin
+        echo("{}: {} processes in {:.3f}s, {:.1f}us per process".format(name, count, spent, spent / count * 1e6))
+    return True
 
 
 def run_setup(function: run_command, *args, required=True, **kwargs) -> None:
@@ -267,6 +935,41 @@ def run_setup(function: run_command, *args, required=True, **kwargs) -> None:
     _process['log_depth'] -= 1
 
 
+def run_setup_snapshot(function: run_command, retries: int) -> None:
+    """
+    Run chain setup step like run_setup() does, but with installation root snapshots.
+
+    After step succeeds, installation root is snapshotted. If step fails, root is rolled back
+    to the last good snapshot and step is retried up to retries times.
+
+    :param function: chain step function
+    :param retries: how many times failed step can be restarted
+    """
+    # Chain is already broken, there is nothing to roll back for
+    if not _process['satisfied']:
+        run_setup(function)
+        return
+
+    while True:
+        run_setup(function)
+        if _process['satisfied']:
+            run_setup(snapshot_take, function.__name__, required=False)
+            return
+
+        try:
+            rolled = snapshot_rollback()
+        except Exception as err:
+            echo(str(err))
+            rolled = False
+
+        if not rolled or retries < 1:
+            return
+
+        retries -= 1
+        echo("Retrying {} from snapshot...".format(function.__name__))
+        _process['satisfied'] = True
+
+
 def install_pacstrap(packages: list) -> bool:
     """
     Install package to installation with pacstrap.
@@ -286,6 +989,42 @@ def install_pacstrap(packages: list) -> bool:
     return True
 
 
+async def sync_pacman_async() -> None:
+    """
+    Sync pacman databases once for installation, like install_pacstrap() does.
+
+    Concurrent callers await the same sync. Sync is marked done only if it succeeds,
+    failed one is started again by the next caller.
+    """
+    global _pacman_sync
+    if _process['pacman_refreshed']:
+        return
+
+    if _pacman_sync is None:
+        _pacman_sync = asyncio.ensure_future(run_command_async('pacman', ['-Sy'], resources=['network', 'pacman']))
+    sync = _pacman_sync
+    try:
+        # One cancelled caller must not cancel sync for others
+        await asyncio.shield(sync)
+    except BaseException:
+        if _pacman_sync is sync and sync.done():
+            _pacman_sync = None
+        raise
+    _process['pacman_refreshed'] = True
+
+
+async def install_pacstrap_async(packages: list) -> bool:
+    """
+    Awaitable version of install_pacstrap().
+
+    :param packages: list of installing packages
+    :return: True if installation was sucessfull
+    """
+    await sync_pacman_async()
+    await run_command_async('pacstrap', [_options['install']] + packages, resources=['network', 'disk', 'pacman'])
+    return True
+
+
 def remove_packages(packages: list) -> bool:
     """
     Remove packages from installation.
@@ -356,21 +1095,37 @@ def install_pkgbuild(pkg: str, dependencies: list) -> bool:
     dir = _options['install'] + dir_rel
     src_f = lambda name: "https://aur.archlinux.org/" + name + ".git"
 
-    install_pacstrap(dependencies+['base-devel'])
-
-    run_command('mkdir', ['-p', dir])
-    run_command('rm', ['-rf', dir + pkg])
-    run_command('git', ['clone', src_f(pkg), dir + pkg])
-    run_command('chmod', ['-R', '777', dir + pkg])
+    # Dependencies are downloading while PKGBUILD is cloning
+    run_parallel(
+        install_pacstrap_async(dependencies+['base-devel']),
+        clone_pkgbuild_async(src_f(pkg), dir + pkg)
+    )
     # if makepkg -d runs without fails we will pacman -U
-    if run_chdir(dir_rel + pkg, 'makepkg', ['-d'], user="nobody", nofail=True, chroot=True, env="GOCACHE="+dir+pkg) == 0:
-        run_chroot('pacman', ['-U', dir_rel + pkg + "/*.pkg.*"])
+    if run_chdir(dir_rel + pkg, 'makepkg', ['-d'], user="nobody", nofail=True, chroot=True, env="GOCACHE="+dir_rel+pkg) == 0:
+        # There is no shell to expand glob, so we do it ourselves
+        built = [path[len(_options['install']):] for path in sorted(glob.glob(dir + pkg + "/*.pkg.*"))]
+        run_chroot('pacman', ['-U', '--noconfirm'] + built)
     else:
         echo("Package was not installed due MAKEPKG FAIL")
 
     return True
 
 
+async def clone_pkgbuild_async(url: str, path: str) -> bool:
+    """
+    Clone PKGBUILD repository to fresh directory, that everyone can build in.
+
+    :param url: git repository url
+    :param path: local directory path
+    :return: True if all fine
+    """
+    await run_command_async('mkdir', ['-p', os.path.dirname(path)], resources=['disk'])
+    await run_command_async('rm', ['-rf', path], resources=['disk'])
+    await run_command_async('git', ['clone', url, path], resources=['network', 'disk'])
+    await run_command_async('chmod', ['-R', '777', path], resources=['disk'])
+    return True
+
+
 def parse_options(argv: list) -> bool:
     """
     Parse program execution parameters from cmdline
@@ -380,12 +1135,13 @@ def parse_options(argv: list) -> bool:
     """
     try:
         _options['params'], _options['arguments'] = getopt.getopt(argv, "c:i:s:",
-                                                                  ['config=', 'install=', 'setup=', 'scripts='])
+                                                                  ['config=', 'install=', 'setup=', 'scripts=',
+                                                                   'bench-spawn=', 'check-mirrors'])
     except getopt.GetoptError:
         echo("Invalid option")
 
     for opt, arg in _options['params']:
-        arg = arg if arg[0] not in (' ') else arg[1:]
+        arg = arg if arg[:1] not in (' ') else arg[1:]
         if opt in ('-c', '--config'):
             _options['configFile'] = arg
         elif opt in ('-i', '--install'):
@@ -394,6 +1150,10 @@ def parse_options(argv: list) -> bool:
             _process['first_setup'] = arg
         elif opt in ('--scripts'):
             _process['needed_system_scripts'] = arg.split(',')
+        elif opt in ('--bench-spawn'):
+            _process['bench_spawn'] = int(arg)
+        elif opt in ('--check-mirrors'):
+            _process['check_mirrors'] = True
 
     return True
 
@@ -440,6 +1200,425 @@ def save_run(path: str) -> bool:
     return True
 
 
+def read_mirrors(path: str) -> list:
+    """
+    Read servers from pacman mirrorlist.
+
+    :param path: mirrorlist path
+    :return: enabled servers. If there are no enabled ones - commented out servers
+    """
+    enabled = []
+    commented = []
+    with open(path, 'r') as file:
+        for line in file:
+            if match := re.match(r'\s*(#)?\s*Server\s*=\s*(\S+)', line):
+                (commented if match.group(1) else enabled).append(match.group(2))
+    return enabled if enabled else commented
+
+
+def probe_mirror(server: str, timeout: float) -> dict:
+    """
+    Measure mirror latency and throughput by downloading core repo database.
+
+    Download is stopped after timeout, throughput is counted for received part.
+    Data is read in small pieces as it comes, so slow mirrors get their real (small) throughput.
+
+    :param server: mirrorlist server, ex. "https://mirror.example/archlinux/$repo/os/$arch"
+    :param timeout: seconds for the whole probe
+    :return: {'latency': seconds or None if unreachable, 'throughput': bytes/s, 'checked': unix time}
+    """
+    url = server.replace('$repo', 'core').replace('$arch', os.uname().machine) + '/core.db'
+    result = {'latency': None, 'throughput': 0.0, 'checked': time.time()}
+    received = 0
+    try:
+        begin = time.perf_counter()
+        deadline = begin + timeout
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            first = time.perf_counter()
+            try:
+                while time.perf_counter() < deadline and (chunk := response.read1(8 * 1024)):
+                    received += len(chunk)
+            # Mirror stopped sending in the middle. What was received is still measured
+            except OSError as err:
+                log("Mirror {} stalled: {}".format(server, err))
+    except (OSError, ValueError) as err:
+        log("Mirror {} is unreachable: {}".format(server, err))
+        return result
+
+    end = min(time.perf_counter(), deadline)
+    result['latency'] = first - begin
+    result['throughput'] = received / max(end - first, 1e-6)
+    return result
+
+
+async def probe_mirror_async(server: str, timeout: float) -> dict:
+    """
+    Awaitable version of probe_mirror(). Uses network resource class.
+
+    :param server: mirrorlist server
+    :param timeout: seconds for the whole probe
+    :return: see probe_mirror()
+    """
+    async with _resources['network']:
+        return await asyncio.to_thread(probe_mirror, server, timeout)
+
+
+def rank_mirrors(servers: list, timeout: float, ttl: float) -> list:
+    """
+    Sort mirrors from the fastest to the slowest, unreachable ones are dropped.
+
+    Probe results are cached in _options['mirror_cache'] and reused until they are older than ttl.
+    Failed probes are not cached: failure may be a short network error, such mirror is probed next time.
+
+    :param servers: mirrorlist servers
+    :param timeout: seconds for one mirror probe
+    :param ttl: seconds cached probe result is valid
+    :return: [(server, probe result), ...] best first
+    """
+    try:
+        with open(_options['mirror_cache'], 'r') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        cache = {}
+
+    outdated = [server for server in servers
+                if server not in cache or cache[server]['latency'] is None
+                or cache[server]['checked'] < time.time() - ttl]
+    echo("Mirrors to probe: {}, cached: {}".format(len(outdated), len(servers) - len(outdated)))
+
+    probes = {server: cache[server] for server in servers if server not in outdated}
+    if outdated:
+        results = run_parallel(*[probe_mirror_async(server, timeout) for server in outdated])
+        probes.update(zip(outdated, results))
+        cache.update((server, probe) for server, probe in zip(outdated, results) if probe['latency'] is not None)
+        with open(_options['mirror_cache'], 'w') as file:
+            json.dump(cache, file)
+
+    ranked = [(server, probes[server]) for server in servers if probes[server]['latency'] is not None]
+    return sorted(ranked, key=lambda mirror: (-mirror[1]['throughput'], mirror[1]['latency']))
+
+
+def write_mirrorlist(path: str, ranked: list) -> bool:
+    """
+    Write ranked mirrorlist.
+
+    :param path: mirrorlist path
+    :param ranked: result of rank_mirrors()
+    :return: True if all fine
+    """
+    with open(path, 'w') as file:
+        file.write("# Ranked by ArchDeclarativeInstall {}\n".format(time.strftime('%Y-%m-%d %H:%M:%S')))
+        for server, probe in ranked:
+            file.write("# latency {:.3f}s, throughput {:.1f} KiB/s\n".format(probe['latency'],
+                                                                          probe['throughput'] / 1024))
+            file.write("Server = {}\n".format(server))
+    return True
+
+
+def set_parallel_downloads(path: str, count: int) -> bool:
+    """
+    Set ParallelDownloads option in pacman config.
+
+    :param path: pacman.conf path
+    :param count: how many packages to download at once
+    :return: True if all fine
+    """
+    with open(path, 'r') as file:
+        conf = file.read()
+
+    option = "ParallelDownloads = {}".format(count)
+    conf, found = re.subn(r'^#?\s*ParallelDownloads\s*=.*$', option, conf, flags=re.MULTILINE)
+    # No such line, even commented. Put it to [options] section
+    if not found:
+        conf = re.sub(r'^\[options\]\s*$', '[options]\n' + option, conf, count=1, flags=re.MULTILINE)
+
+    with open(path, 'w') as file:
+        file.write(conf)
+    return True
+
+
+def serve_mirror(rate: int) -> http.server.ThreadingHTTPServer:
+    """
+    Start local HTTP mirror stand-in for check_mirrors().
+
+    Every path is served as 64 KiB core.db, sent in 1 KiB pieces.
+
+    :param rate: bytes per second. 0 for no limit
+    :return: running server, shutdown() it after use
+    """
+    class Mirror(http.server.BaseHTTPRequestHandler):
+        requests = 0
+
+        def do_GET(self):
+            Mirror.requests += 1
+            data = b'x' * 64 * 1024
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            try:
+                for start in range(0, len(data), 1024):
+                    self.wfile.write(data[start:start + 1024])
+                    self.wfile.flush()
+                    if rate:
+                        time.sleep(1024 / rate)
+            # Probe stops reading after its timeout
+            except OSError:
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Mirror)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check_mirrors() -> bool:
+    """
+    Self-check of mirror ranking against local HTTP mirror stand-ins serving at different speeds.
+
+    Checks ranking order, probe timeout, probe cache, mirrorlist and pacman.conf writing.
+    Nothing outside of temporary directory is touched.
+
+    :return: True if all fine. Raises Exception on the first failed check
+    """
+    timeout = 2
+    servers = {'fast': serve_mirror(0), 'medium': serve_mirror(128 * 1024), 'slow': serve_mirror(8 * 1024)}
+    mirrors = {name: "http://127.0.0.1:{}/$repo/os/$arch".format(server.server_port)
+               for name, server in servers.items()}
+    # Nobody listens there
+    mirrors['dead'] = "http://127.0.0.1:9/$repo/os/$arch"
+    saved_cache = _options['mirror_cache']
+
+    def check(condition: bool, what: str) -> None:
+        if not condition:
+            raise Exception("Mirror check failed: " + what)
+        echo("OK: " + what)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            _options['mirror_cache'] = tmp + "/cache.json"
+
+            begin = time.perf_counter()
+            slow = probe_mirror(mirrors['slow'], timeout)
+            spent = time.perf_counter() - begin
+            check(spent < timeout + 0.5, "slow probe stops at timeout ({:.2f}s)".format(spent))
+            check(slow['throughput'] > 0, "slow mirror throughput is measured ({:.0f} B/s)".format(slow['throughput']))
+
+            order = [mirrors['slow'], mirrors['dead'], mirrors['fast'], mirrors['medium']]
+            ranked = rank_mirrors(order, timeout, 3600)
+            check([server for server, _ in ranked] == [mirrors['fast'], mirrors['medium'], mirrors['slow']],
+                  "mirrors are ranked by speed, unreachable one is dropped")
+
+            with open(_options['mirror_cache'], 'r') as file:
+                check(mirrors['dead'] not in json.load(file), "failed probe is not cached")
+
+            requests = {name: server.RequestHandlerClass.requests for name, server in servers.items()}
+            rank_mirrors(order, timeout, 3600)
+            check(all(server.RequestHandlerClass.requests == requests[name] for name, server in servers.items()),
+                  "cached mirrors are not probed again")
+
+            write_mirrorlist(tmp + "/mirrorlist", ranked)
+            check(read_mirrors(tmp + "/mirrorlist") == [server for server, _ in ranked],
+                  "ranked mirrorlist is written in order")
+
+            with open(tmp + "/pacman.conf", 'w') as file:
+                file.write("[options]\nHoldPkg = pacman\n#ParallelDownloads = 5\n")
+            set_parallel_downloads(tmp + "/pacman.conf", 7)
+            with open(tmp + "/pacman.conf", 'r') as file:
+                options = re.findall(r'^ParallelDownloads.*$', file.read(), flags=re.MULTILINE)
+                check(options == ["ParallelDownloads = 7"], "ParallelDownloads is set")
+    finally:
+        _options['mirror_cache'] = saved_cache
+        for server in servers.values():
+            server.shutdown()
+
+    return True
+
+
+def find_mounts() -> (dict, list):
+    """
+    Find partitions to mount in config.
+
+    :return: (root partition config, [other mounted partitions configs])
+    """
+    rootmount = {}  # Root filesystem device config
+    mounts = []
+    for part in _options['configData']['hardware']['partitions']:
+        if part['mount']:
+            if part['mount'] == '/':
+                rootmount = part
+            else:
+                mounts.append(part)
+
+    # Rootmount must be
+    if not rootmount:
+        raise Exception("No Root mountpoint was specified in config!")
+
+    return rootmount, mounts
+
+
+def mount_filesystems(rootmount: dict, mounts: list) -> bool:
+    """
+    Mount installation root and other partitions to it.
+
+    :param rootmount: root partition config
+    :param mounts: other partitions configs
+    :return: True if all fine
+    """
+    root_options = shlex.split(rootmount['mount_options'])
+    if snapshots_used():
+        root_options += ['-o', 'subvol=' + _options['root_subvolume']]
+
+    run_command('mkdir', [_options['install'], '-p'])
+    run_command('mount', root_options + [rootmount['dev'], _options['install'] + rootmount['mount']])
+
+    for mount in mounts:
+        run_command('mkdir', ['-p', _options['install'] + mount['mount']])
+        run_command('mount', shlex.split(mount['mount_options']) + [mount['dev'], _options['install'] + mount['mount']])
+
+    return True
+
+
+def snapshots_used() -> bool:
+    """
+    Check if installation root is snapshotted after every chain step.
+
+    Only btrfs root partition, formatted by this installation, is supported.
+
+    :return: True if snapshots are on
+    """
+    snapshots = _options['configData'].get('snapshots')
+    if not snapshots or not snapshots['use']:
+        return False
+    return find_mounts()[0]['fs'] == 'btrfs'
+
+
+def snapshot_pool() -> str:
+    """
+    Mount btrfs top-level volume of root partition, if it is not mounted yet.
+
+    Root subvolume and its snapshots live there side by side.
+
+    :return: mount path
+    """
+    pool = _options['snapshot_pool']
+    if not os.path.ismount(pool):
+        run_command('mkdir', ['-p', pool])
+        run_command('mount', ['-o', 'subvolid=5', find_mounts()[0]['dev'], pool])
+    return pool
+
+
+def snapshot_take(step: str) -> bool:
+    """
+    Take read-only snapshot of installation root after successful chain step.
+
+    Other partitions (ex. /boot/efi) are not snapshotted.
+
+    :param step: chain step name
+    :return: True if all fine
+    """
+    pool = snapshot_pool()
+    path = pool + "/.adi-snapshots/{:02}-{}".format(len(_process['snapshots']), step)
+    run_command('mkdir', ['-p', pool + "/.adi-snapshots"])
+    run_command('btrfs', ['subvolume', 'snapshot', '-r', pool + '/' + _options['root_subvolume'], path])
+
+    # Steps also leave tracks in process data. They have to be rolled back too
+    _process['snapshots'].append({'step': step, 'path': path, 'state': copy.deepcopy({
+        'needed_system_scripts': _process['needed_system_scripts'],
+        'needed_script_packages': _process['needed_script_packages'],
+        'installed_system_scripts': _options['installed_system_scripts'],
+        'installed_script_packages': _options['installed_script_packages'],
+    })})
+    return True
+
+
+def snapshot_rollback() -> bool:
+    """
+    Replace installation root with the last snapshot and mount everything again.
+
+    :return: True if rolled back, False if there is no snapshot
+    """
+    if not _process['snapshots']:
+        echo("No snapshot to roll back to")
+        return False
+
+    last = _process['snapshots'][-1]
+    echo("Rolling back to snapshot after " + last['step'])
+    pool = snapshot_pool()
+    root = pool + '/' + _options['root_subvolume']
+    trash = pool + "/.adi-snapshots/failed-{:02}".format(len(_process['snapshot_trash']))
+
+    run_command('umount', ['-R', _options['install']])
+    # Broken root may have nested subvolumes, so it is moved away, not deleted
+    run_command('mv', [root, trash])
+    _process['snapshot_trash'].append(trash)
+    run_command('btrfs', ['subvolume', 'snapshot', last['path'], root])
+    # Restored root is a new subvolume, it has to become default again
+    run_command('btrfs', ['subvolume', 'set-default', root])
+    mount_filesystems(*find_mounts())
+
+    _process['needed_system_scripts'] = copy.deepcopy(last['state']['needed_system_scripts'])
+    _process['needed_script_packages'] = copy.deepcopy(last['state']['needed_script_packages'])
+    _options['installed_system_scripts'] = copy.deepcopy(last['state']['installed_system_scripts'])
+    _options['installed_script_packages'] = copy.deepcopy(last['state']['installed_script_packages'])
+    return True
+
+
+def snapshot_cleanup() -> bool:
+    """
+    Delete all snapshots and broken roots with their directory, unmount btrfs top-level volume.
+
+    :return: True if everything is deleted. Left paths are reported
+    """
+    echo("Cleaning up snapshots")
+    left = []
+    # Snapshots are read-only and have no nested subvolumes
+    for path in [snapshot['path'] for snapshot in _process['snapshots']]:
+        if run_command('btrfs', ['subvolume', 'delete', path], nofail=True) != 0:
+            left.append(path)
+    # Broken roots may have nested subvolumes (ex. created by systemd-tmpfiles)
+    for path in _process['snapshot_trash']:
+        if run_command('btrfs', ['subvolume', 'delete', '--recursive', path], nofail=True) != 0:
+            left.append(path)
+
+    snapshots_dir = _options['snapshot_pool'] + "/.adi-snapshots"
+    if os.path.isdir(snapshots_dir) and run_command('rmdir', [snapshots_dir], nofail=True) != 0:
+        left.append(snapshots_dir)
+    run_command('umount', [_options['snapshot_pool']], nofail=True)
+
+    _process['snapshots'] = []
+    _process['snapshot_trash'] = []
+    for path in left:
+        echo("Could not delete {}, remove it manually from top-level volume of root partition".format(path))
+    return not left
+
+
+def strip_fstab_subvolid(path: str) -> bool:
+    """
+    Remove subvolid= from btrfs fstab entries, leaving subvol= only.
+
+    Rollback replaces root subvolume with a snapshot that has another id,
+    so id written by genfstab would point to deleted subvolume.
+
+    :param path: fstab path
+    :return: True if all fine
+    """
+    with open(path, 'r') as file:
+        lines = file.readlines()
+
+    for index, line in enumerate(lines):
+        fields = line.split()
+        if len(fields) > 3 and not fields[0].startswith('#') and fields[2] == 'btrfs':
+            fields[3] = ','.join(option for option in fields[3].split(',') if not option.startswith('subvolid='))
+            lines[index] = '\t'.join(fields) + '\n'
+
+    with open(path, 'w') as file:
+        file.writelines(lines)
+    return True
+
+
 def configure_filesystems() -> bool:
     """
     Creates filesystems, mounts them as stated in config.
@@ -450,26 +1629,18 @@ def configure_filesystems() -> bool:
     :return: True is all fine
     """
     swaps = []  # Swap partitions
-    mounts = []
-    rootmount = {}  # Root filesystem device config
     partitions = _options['configData']['hardware']['partitions']
 
     for part in partitions:
         if part['dev']:
             run_command('umount', ['-f', part['dev']], nofail=True)
 
-        if part['mount']:
-            if part['mount'] == '/':
-                rootmount = part
-            else:
-                mounts.append(part)
-
-    # Rootmount must be
-    if not rootmount:
-        raise Exception("No Root mountpoint was specified in config!")
+    rootmount, mounts = find_mounts()
 
     # Root partition can be mounted because it was not unmounted earlier for "busy" error.
     run_command('umount', ['-f', rootmount['dev']], nofail=True)
+    if snapshots_used():
+        run_command('umount', [_options['snapshot_pool']], nofail=True)
 
     for part in partitions:
         if part['dev']:
@@ -482,14 +1653,16 @@ def configure_filesystems() -> bool:
             else:
                 mkfs = "mkfs." + part['fs']
 
-            run_command(mkfs, [part['fs_options'], part['dev']])
+            run_command(mkfs, shlex.split(part['fs_options']) + [part['dev']])
 
-    run_command('mkdir', [_options['install'], '-p'])
-    run_command('mount', [rootmount['mount_options'], rootmount['dev'], _options['install'] + rootmount['mount']])
+    if snapshots_used():
+        # Installation root lives in subvolume, so it can be replaced by snapshot on rollback
+        root = snapshot_pool() + '/' + _options['root_subvolume']
+        run_command('btrfs', ['subvolume', 'create', root])
+        # Kernel mounts default subvolume if cmdline has no rootflags=subvol=
+        run_command('btrfs', ['subvolume', 'set-default', root])
 
-    for mount in mounts:
-        run_command('mkdir', ['-p', _options['install'] + mount['mount']])
-        run_command('mount', [mount['mount_options'], mount['dev'], _options['install'] + mount['mount']])
+    mount_filesystems(rootmount, mounts)
 
     for swap in swaps:
         run_command('swapon', [swap['dev']])
@@ -497,6 +1670,41 @@ def configure_filesystems() -> bool:
     return True
 
 
+def configure_mirrors() -> bool:
+    """
+    Rank live system mirrors and tune pacman downloads.
+
+    Installation chain step.
+    Have to be used in run_step() only.
+
+    pacstrap copies live system mirrorlist to installation, so it gets ranked one too.
+    Original mirrorlist is kept and always used as a source of servers to probe.
+
+    :return: True if all fine
+    """
+    mirrors = _options['configData'].get('mirrors')
+    if not mirrors:
+        echo("No mirrors configuration. Live system pacman settings will be used")
+        return True
+
+    if mirrors['rank']:
+        original = _options['mirrorlist'] + '.adi-orig'
+        if not os.path.exists(original):
+            run_command('cp', ['-f', _options['mirrorlist'], original])
+
+        ranked = rank_mirrors(read_mirrors(original), mirrors['probe_timeout'], mirrors['cache_ttl'])
+        if ranked:
+            write_mirrorlist(_options['mirrorlist'], ranked[:mirrors['keep']])
+            echo("Fastest mirror: " + ranked[0][0])
+            # Databases have to be synced from new mirrors
+            _process['pacman_refreshed'] = False
+        else:
+            echo("No mirror is reachable. Mirrorlist is left as it was")
+
+    set_parallel_downloads(_options['pacman_conf'], mirrors['parallel_downloads'])
+    return True
+
+
 def install_world() -> bool:
     """
     Install all system packages.
@@ -567,12 +1775,16 @@ def configure_world() -> bool:
     run_chroot('timedatectl', ['set-ntp', _system['systemd']['ntp']])
     run_chroot('hostnamectl', ['set-hostname', _system['systemd']['hostname']])
 
-    run_command('echo', ['-e', '\"{}\"'.format('\\n'.join(_system['systemd']['locales'])), '>',
-                         _options['install'] + "/etc/locale.gen"])
+    run_command('echo', ['\n'.join(_system['systemd']['locales'])], output=_options['install'] + "/etc/locale.gen")
     run_chroot('locale-gen', [])
     run_chroot('localectl', ['set-locale', "LANG=" + _system['systemd']['main_locale']], nofail=True)
 
-    run_command('genfstab', ["-U", _options['install'], '>>', _options['install'] + "/etc/fstab"])
+    run_command('genfstab', ["-U", _options['install']], output=_options['install'] + "/etc/fstab", append=True)
+    if snapshots_used():
+        strip_fstab_subvolid(_options['install'] + "/etc/fstab")
+
+    if mirrors := _options['configData'].get('mirrors'):
+        set_parallel_downloads(_options['install'] + "/etc/pacman.conf", mirrors['parallel_downloads'])
 
     echo("Configure ROOT password (safe UNIX passwd command used. Enter password Twice!):")
     run_chroot('passwd', ['root'], direct=True, attempts=2)
@@ -661,22 +1873,24 @@ def uki_efistub() -> bool:
             ucode = _options['install']+_known_ucodes[_system['ucode']] if _system['ucode'] in _known_ucodes.keys() else None
 
             run_command('mkdir', ['-p', _options['install'] + _bootloader['uki']['gen_dest']])
-            run_command('echo', ['\"{}\"'.format(cmdline), '>', _options['install'] + '/etc/kernel/cmdline-' + kernel])
+            run_command('echo', [cmdline], output=_options['install'] + '/etc/kernel/cmdline-' + kernel)
 
+            initram_ucode = initram
+            ukipath = _options['install'] + _bootloader['uki']['gen_dest'] + "/" + kernel + ".efi"
             if ucode:
-                run_command('cat',
-                            [ucode, initram, '>', ''.join(initram.split('.')[:-1]) + "-" + _system['ucode'] + '.img'])
                 initram_ucode = ''.join(initram.split('.')[:-1]) + "-" + _system['ucode'] + '.img'
-                ukipath = _options['install'] + _bootloader['uki']['gen_dest'] + "/" + kernel + ".efi"
+                run_command('cat', [ucode, initram], output=initram_ucode)
 
             uki_params = [
-                '--add-section .osrel="{}/usr/lib/os-release" --change-section-vma .osrel=0x20000'.format(
-                    _options['install']),
-                '--add-section .cmdline="{}/etc/kernel/cmdline-{}" --change-section-vma .cmdline=0x30000'.format(
-                    _options['install'], kernel),
-                '--add-section .linux="{}" --change-section-vma .linux=0x2000000'.format(kernelpath),
-                '--add-section .initrd="{}" --change-section-vma .initrd=0x3000000'.format(initram_ucode),
-                '"/usr/lib/systemd/boot/efi/linuxx64.efi.stub" "{}"'.format(ukipath)
+                '--add-section', '.osrel={}/usr/lib/os-release'.format(_options['install']),
+                '--change-section-vma', '.osrel=0x20000',
+                '--add-section', '.cmdline={}/etc/kernel/cmdline-{}'.format(_options['install'], kernel),
+                '--change-section-vma', '.cmdline=0x30000',
+                '--add-section', '.linux={}'.format(kernelpath),
+                '--change-section-vma', '.linux=0x2000000',
+                '--add-section', '.initrd={}'.format(initram_ucode),
+                '--change-section-vma', '.initrd=0x3000000',
+                '/usr/lib/systemd/boot/efi/linuxx64.efi.stub', ukipath
             ]
 
             run_command('rm', [ukipath], nofail=True)
@@ -770,8 +1984,308 @@ def script_packages() -> bool:
     return True
 
 
+def mtree_unescape(name: str) -> str:
+    """
+    Decode mtree octal escapes, ex. "\\040" is space.
+
+    :param name: escaped mtree path
+    :return: real path
+    """
+    raw = re.sub(rb'\\([0-7]{3})', lambda match: bytes([int(match.group(1), 8)]),
+                 name.encode('utf-8', 'surrogateescape'))
+    return raw.decode('utf-8', 'surrogateescape')
+
+
+def read_mtree(path: str) -> list:
+    """
+    Read package files from local pacman database mtree file.
+
+    :param path: path to gzipped mtree file
+    :return: [{'path': '/usr/bin/x', 'type': 'file', 'size': '123', 'sha256digest': '...', ...}, ...]
+    """
+    entries = []
+    defaults = {}
+    with gzip.open(path, 'rt', encoding='utf-8', errors='surrogateescape') as file:
+        for line in file:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            keywords = dict(word.split('=', 1) if '=' in word else (word, '') for word in words[1:])
+            if words[0] == '/set':
+                defaults.update(keywords)
+            elif words[0] == '/unset':
+                for key in keywords:
+                    defaults.pop(key, None)
+            # ./.PKGINFO, ./.BUILDINFO etc. are package metadata, not installed
+            elif not words[0].startswith('./.'):
+                entry = {**defaults, **keywords}
+                entry['path'] = mtree_unescape(words[0])[1:]
+                if 'link' in entry:
+                    entry['link'] = mtree_unescape(entry['link'])
+                entries.append(entry)
+    return entries
+
+
+def read_backups(path: str) -> set:
+    """
+    Read package backup files (they are allowed to be changed) from local pacman database desc file.
+
+    :param path: path to desc file
+    :return: {'/etc/pacman.conf', ...}
+    """
+    backups = set()
+    with open(path, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        section = None
+        for line in file:
+            line = line.rstrip('\n')
+            if line.startswith('%') and line.endswith('%'):
+                section = line
+            elif line and section == '%BACKUP%':
+                backups.add('/' + line.split('\t')[0])
+    return backups
+
+
+def hash_file(path: str, algorithm: str) -> str:
+    """
+    Hash file content. Big files are hashed straight from mmap, others chunk by chunk.
+
+    hashlib releases GIL for big buffers, so files can be hashed in threads.
+
+    :param path: file path
+    :param algorithm: hashlib algorithm name
+    :return: hex digest
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size >= 16 * 1024 * 1024:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+        else:
+            while chunk := file.read(1024 * 1024):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_file(root: str, entry: dict, backup: bool) -> (str, int):
+    """
+    Check one installed package file against its mtree entry.
+
+    :param root: installation root
+    :param entry: mtree entry, see read_mtree()
+    :param backup: file is package backup file, its content can be changed
+    :return: (problem description or None, bytes hashed)
+    """
+    path = root + entry['path']
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return "missing", 0
+
+    kind = entry.get('type', 'file')
+    if kind == 'dir':
+        return (None if stat.S_ISDIR(info.st_mode) else "not a directory"), 0
+    if kind == 'link':
+        if not stat.S_ISLNK(info.st_mode):
+            return "not a symlink", 0
+        return (None if os.readlink(path) == entry['link'] else "symlink target changed"), 0
+    if not stat.S_ISREG(info.st_mode):
+        return "not a file", 0
+    if backup:
+        return None, 0
+
+    if 'size' in entry and info.st_size != int(entry['size']):
+        return "size {} instead of {}".format(info.st_size, entry['size']), 0
+
+    for key, algorithm in (('sha256digest', 'sha256'), ('md5digest', 'md5')):
+        if key in entry:
+            if hash_file(path, algorithm) != entry[key]:
+                return algorithm + " mismatch", info.st_size
+            return None, info.st_size
+    return None, 0
+
+
+def verify_files(root: str, files: list) -> (list, int):
+    """
+    Check batch of package files. Runs in verify_packages() pool.
+
+    :param root: installation root
+    :param files: [(package, mtree entry, is backup), ...]
+    :return: ([{'package', 'path', 'problem'}, ...], bytes hashed)
+    """
+    problems = []
+    hashed = 0
+    for package, entry, backup in files:
+        try:
+            problem, size = verify_file(root, entry, backup)
+        except OSError as err:
+            problem, size = str(err), 0
+        hashed += size
+        if problem:
+            problems.append({'package': package, 'path': entry['path'], 'problem': problem})
+    return problems, hashed
+
+
+def verify_packages(root: str, workers: int) -> dict:
+    """
+    Check files of all packages installed to root, reading its local pacman database directly.
+
+    :param root: installation root
+    :param workers: threads to hash files in
+    :return: report part {'packages', 'files', 'bytes', 'seconds', 'problems'}
+    """
+    begin = time.perf_counter()
+    files = []
+    packages = sorted(glob.glob(root + "/var/lib/pacman/local/*/mtree"))
+    for mtree in packages:
+        package = os.path.basename(os.path.dirname(mtree))
+        backups = read_backups(os.path.dirname(mtree) + "/desc")
+        files += [(package, entry, entry['path'] in backups) for entry in read_mtree(mtree)]
+
+    problems = []
+    hashed = 0
+    # Batches, not single files, so pool overhead does not eat small files time
+    batches = [files[start:start + 256] for start in range(0, len(files), 256)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch_problems, batch_hashed in pool.map(lambda batch: verify_files(root, batch), batches):
+            problems += batch_problems
+            hashed += batch_hashed
+
+    return {
+        'packages': len(packages),
+        'files': len(files),
+        'bytes': hashed,
+        'seconds': time.perf_counter() - begin,
+        'problems': problems,
+    }
+
+
+def read_pe_section(path: str, name: str) -> bytes:
+    """
+    Read section content from PE (EFI) image.
+
+    :param path: image path
+    :param name: section name, ex. ".cmdline"
+    :return: section content or None if there is no such section
+    """
+    with open(path, 'rb') as file:
+        image = file.read()
+
+    pe = struct.unpack_from('<I', image, 0x3c)[0]
+    if image[pe:pe + 4] != b'PE\0\0':
+        return None
+    sections, optional_size = struct.unpack_from('<H', image, pe + 6)[0], struct.unpack_from('<H', image, pe + 20)[0]
+    table = pe + 24 + optional_size
+    for index in range(sections):
+        header = table + index * 40
+        if image[header:header + 8].rstrip(b'\0') == name.encode():
+            virtual_size, _, raw_size, raw_pointer = struct.unpack_from('<IIII', image, header + 8)
+            return image[raw_pointer:raw_pointer + min(virtual_size or raw_size, raw_size)]
+    return None
+
+
+def unit_enabled(root: str, unit: str) -> bool:
+    """
+    Check if systemd unit is enabled in installation, directly or by alias (ex. display-manager.service).
+
+    :param root: installation root
+    :param unit: unit file name, ex. "sddm.service"
+    :return: True if enabled
+    """
+    for path in glob.glob(root + "/etc/systemd/system/**", recursive=True):
+        if os.path.islink(path) and unit in (os.path.basename(path), os.path.basename(os.readlink(path))):
+            return True
+    return False
+
+
+def verify_boot(root: str) -> list:
+    """
+    Check that generated UKIs, fstab and enabled units match config.
+
+    :param root: installation root
+    :return: [{'check', 'path', 'problem'}, ...]
+    """
+    problems = []
+
+    if _bootloader['uki']['use_uki']:
+        for kern_data in _system['kernels']:
+            path = root + _bootloader['uki']['gen_dest'] + "/" + kern_data['version'] + ".efi"
+            try:
+                cmdline = read_pe_section(path, '.cmdline')
+                if cmdline is None or read_pe_section(path, '.linux') is None:
+                    problems.append({'check': 'uki', 'path': path, 'problem': "not an UKI"})
+                elif cmdline.decode(errors='replace').strip('\0\n ') != kern_data['cmdline']:
+                    problems.append({'check': 'uki', 'path': path, 'problem': "cmdline differs from config"})
+            except (OSError, struct.error) as err:
+                problems.append({'check': 'uki', 'path': path, 'problem': str(err)})
+
+    fstab = []
+    try:
+        with open(root + "/etc/fstab", 'r') as file:
+            fstab = [line.split() for line in file if line.strip() and not line.lstrip().startswith('#')]
+    except OSError as err:
+        problems.append({'check': 'fstab', 'path': root + "/etc/fstab", 'problem': str(err)})
+
+    for part in _options['configData']['hardware']['partitions']:
+        if part['fs'] == 'swap':
+            found = any(len(fields) > 2 and fields[2] == 'swap' for fields in fstab)
+        elif part['mount']:
+            found = any(len(fields) > 2 and fields[1] == part['mount'] and (not part['fs'] or fields[2] == part['fs'])
+                        for fields in fstab)
+        else:
+            continue
+        if not found:
+            problems.append({'check': 'fstab', 'path': part['dev'], 'problem': "no matching fstab entry"})
+
+    if not unit_enabled(root, _system['dm'] + ".service"):
+        problems.append({'check': 'units', 'path': _system['dm'] + ".service", 'problem': "not enabled"})
+
+    return problems
+
+
+def verify_installation() -> bool:
+    """
+    Check that installed files are intact and boot configuration matches config.
+
+    Installation chain step.
+    Have to be used in run_step() only.
+
+    Files are checked against installation local pacman database (sizes and hashes), in parallel.
+    Machine-readable report is saved locally and to installation (see _options['verify_report']).
+
+    :return: True if nothing is broken
+    """
+    root = _options['install']
+    report = verify_packages(root, _process['resource_limits']['cpu'])
+    report['throughput_mib_s'] = report['bytes'] / 1024 / 1024 / max(report['seconds'], 1e-6)
+    report['files_per_s'] = report['files'] / max(report['seconds'], 1e-6)
+    report['boot_problems'] = verify_boot(root)
+    report['ok'] = not report['problems'] and not report['boot_problems']
+
+    echo("Verified {} files of {} packages in {:.1f}s ({:.1f} MiB/s, {:.0f} files/s)".format(
+        report['files'], report['packages'], report['seconds'], report['throughput_mib_s'], report['files_per_s']))
+    for problem in report['problems'] + report['boot_problems']:
+        echo("{}: {}".format(problem['path'], problem['problem']))
+
+    for path in (_options['verify_report'], root + _options['verify_report']):
+        run_command('mkdir', ['-p', os.path.dirname(path)])
+        with open(path, 'w') as file:
+            json.dump(report, file, indent=2)
+    echo("Verification report is stored in " + _options['verify_report'])
+
+    return report['ok']
+
+
 if __name__ == "__main__":
     run_setup(parse_options, sys.argv[1:])
+
+    if _process['bench_spawn']:
+        run_setup(bench_spawn, _process['bench_spawn'])
+        sys.exit(0)
+
+    if _process['check_mirrors']:
+        run_setup(check_mirrors)
+        sys.exit(0 if _process['satisfied'] else 1)
+
     run_setup(read_config)
 
     # Shortcuts for frequently used parts of _options
@@ -790,6 +2304,18 @@ if __name__ == "__main__":
 
     time.sleep(5)
 
+    # Chain steps can be retried from installation root snapshots
+    use_snapshots = snapshots_used()
+    if use_snapshots:
+        echo("Installation root will be snapshotted after every step")
+
     # run all steps
     for setup in _process['setup_chain'][setup_first_index:]:
-        run_setup(eval(setup))
+        if use_snapshots:
+            run_setup_snapshot(eval(setup), _options['configData']['snapshots']['retries'])
+        else:
+            run_setup(eval(setup))
+
+    # Whatever happened, snapshots are not needed anymore
+    if use_snapshots:
+        snapshot_cleanup()